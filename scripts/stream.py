@@ -12,17 +12,147 @@ Author: Philipp Rothenhaeusler, Stockholm 2020
 import os
 import sys
 import time
+import errno
+import mmap
 import fcntl
+import struct
+import ctypes
+import threading
+import multiprocessing
+import ctypes.util
 
 import cv2
-import v4l2
 import numpy
 import rospy
 
-from cv_bridge import CvBridge
-
-from sensor_msgs.msg import Image
-
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _fourcc(code):
+    """ Return the little endian integer of a four character pixel format code. """
+    return struct.unpack('<I', code.encode('ascii'))[0]
+
+def _ioc(direction, nr, size):
+    """ Return the request number of a video4linux2 ('V') ioctl command. """
+    return (direction << 30) | (size << 16) | (ord('V') << 8) | nr
+
+# Video4Linux2 ABI (linux/videodev2.h)
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_READWRITE = 0x01000000
+V4L2_CAP_STREAMING = 0x04000000
+V4L2_PIX_FMT_YUYV = _fourcc('YUYV')
+V4L2_PIX_FMT_NV12 = _fourcc('NV12')
+V4L2_BUF_TYPE_VIDEO_OUTPUT = 2
+V4L2_FIELD_NONE = 1
+V4L2_COLORSPACE_SMPTE170M = 1
+V4L2_YCBCR_ENC_601 = 1
+V4L2_QUANTIZATION_LIM_RANGE = 2
+# Marks v4l2_pix_format fields after priv (ycbcr_enc, quantization, ...) as valid
+V4L2_PIX_FMT_PRIV_MAGIC = 0xfeedcafe
+V4L2_MEMORY_MMAP = 1
+# struct v4l2_capability: driver, card, bus_info, version, capabilities, device_caps, reserved[3]
+V4L2_CAPABILITY = struct.Struct('16s32s32s3I3I')
+# struct v4l2_pix_format embedded in the pointer aligned union of struct v4l2_format
+V4L2_PIX_FORMAT = struct.Struct('12I')
+V4L2_PIX_FIELDS = ('width', 'height', 'pixelformat', 'field', 'bytesperline', 'sizeimage',
+                   'colorspace', 'priv', 'flags', 'ycbcr_enc', 'quantization', 'xfer_func')
+V4L2_FORMAT_PIX_OFFSET = struct.calcsize('P')
+V4L2_FORMAT_SIZE = V4L2_FORMAT_PIX_OFFSET + 200
+# struct v4l2_requestbuffers: count, type, memory, capabilities, flags and reserved
+V4L2_REQUESTBUFFERS = struct.Struct('5I')
+# struct v4l2_buffer: index, type, bytesused, flags, field, timestamp, timecode, sequence,
+#                     memory, m (offset union), length, reserved2, request_fd (native padding)
+V4L2_BUFFER = struct.Struct('@5I2l2I8B2IP3I0P')
+V4L2_BUFFER_MEMORY = 18
+_IOC_WRITE = 1
+_IOC_READ = 2
+VIDIOC_QUERYCAP = _ioc(_IOC_READ, 0, V4L2_CAPABILITY.size)
+VIDIOC_G_FMT = _ioc(_IOC_READ | _IOC_WRITE, 4, V4L2_FORMAT_SIZE)
+VIDIOC_S_FMT = _ioc(_IOC_READ | _IOC_WRITE, 5, V4L2_FORMAT_SIZE)
+VIDIOC_REQBUFS = _ioc(_IOC_READ | _IOC_WRITE, 8, V4L2_REQUESTBUFFERS.size)
+VIDIOC_QUERYBUF = _ioc(_IOC_READ | _IOC_WRITE, 9, V4L2_BUFFER.size)
+VIDIOC_QBUF = _ioc(_IOC_READ | _IOC_WRITE, 15, V4L2_BUFFER.size)
+VIDIOC_DQBUF = _ioc(_IOC_READ | _IOC_WRITE, 17, V4L2_BUFFER.size)
+VIDIOC_STREAMON = _ioc(_IOC_WRITE, 18, struct.calcsize('i'))
+VIDIOC_STREAMOFF = _ioc(_IOC_WRITE, 19, struct.calcsize('i'))
+
+
+def _load_libyuv():
+    """ Load libyuv for single pass conversions if available, otherwise None. """
+    path = ctypes.util.find_library('yuv')
+    if path is None:
+        return None
+    try:
+        lib = ctypes.CDLL(path)
+    except OSError:
+        return None
+    # int ARGBToYUY2(src_argb, src_stride_argb, dst_yuy2, dst_stride_yuy2, width, height)
+    lib.ARGBToYUY2.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                               ctypes.c_void_p, ctypes.c_int,
+                               ctypes.c_int, ctypes.c_int]
+    lib.ARGBToYUY2.restype = ctypes.c_int
+    # int ARGBToNV12(src_argb, src_stride_argb, dst_y, dst_stride_y, dst_uv, dst_stride_uv, width, height)
+    lib.ARGBToNV12.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                               ctypes.c_void_p, ctypes.c_int,
+                               ctypes.c_void_p, ctypes.c_int,
+                               ctypes.c_int, ctypes.c_int]
+    lib.ARGBToNV12.restype = ctypes.c_int
+    return lib
+
+LIBYUV = _load_libyuv()
+
+# Limited range ITU-R BT.601 in R, G, B coefficients and offset per Y, U, V row (see _bgr_to_yuyv)
+BT601 = numpy.array([[66., 129., 25., 16. * 256],
+                     [-38., -74., 112., 128. * 256],
+                     [112., -94., -18., 128. * 256]]) / 256.
+
+# Alignment of frame buffers in bytes (cache line, AVX-512 vector width)
+ALIGNMENT = 64
+# Rows converted per parallel task, keeps source and destination strips cache resident
+TILE_ROWS = 8
+
+
+def _aligned_zeros(size, alignment=ALIGNMENT):
+    """ Return zeroed uint8 buffer whose first byte lies on an alignment boundary. """
+    raw = numpy.zeros(size + alignment, dtype=numpy.uint8)
+    offset = -raw.ctypes.data % alignment
+    return raw[offset:offset + size]
+
+
+def _bgr_to_yuyv(src, dst):
+    """ Convert BGR(A) image (H, W, C) to yuyv pixel pairs (H, W/2, 4) in one pass.
+
+        Uses integer ITU-R BT.601 coefficients with averaged chroma per pixel pair.
+    """
+    height, pairs = dst.shape[0], dst.shape[1]
+    for tile in numba.prange((height + TILE_ROWS - 1) // TILE_ROWS):
+        for y in range(tile * TILE_ROWS, min(height, (tile + 1) * TILE_ROWS)):
+            for i in range(pairs):
+                x = 2 * i
+                b0 = numba.int32(src[y, x, 0])
+                g0 = numba.int32(src[y, x, 1])
+                r0 = numba.int32(src[y, x, 2])
+                b1 = numba.int32(src[y, x + 1, 0])
+                g1 = numba.int32(src[y, x + 1, 1])
+                r1 = numba.int32(src[y, x + 1, 2])
+                b = (b0 + b1 + 1) >> 1
+                g = (g0 + g1 + 1) >> 1
+                r = (r0 + r1 + 1) >> 1
+                dst[y, i, 0] = ((66 * r0 + 129 * g0 + 25 * b0 + 128) >> 8) + 16
+                dst[y, i, 1] = ((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128
+                dst[y, i, 2] = ((66 * r1 + 129 * g1 + 25 * b1 + 128) >> 8) + 16
+                dst[y, i, 3] = ((112 * r - 94 * g - 18 * b + 128) >> 8) + 128
+
+if numba is not None:
+    # Eagerly compile for C-contiguous frames only, cached on disk across restarts
+    # (source is a read-only view on the ROS message data)
+    _bgr_to_yuyv = numba.njit([numba.void(numba.types.Array(numba.uint8, 3, 'C', readonly=True),
+                                          numba.uint8[:, :, ::1])],
+                              parallel=True, fastmath=True, boundscheck=False,
+                              cache=True)(_bgr_to_yuyv)
 
 
 class Loopback(object):
@@ -32,10 +162,18 @@ class Loopback(object):
         self.name = name
         self.config = dict()
         self._fd = None
+        self._fd_int = None
+        self._mmaps = []
+        self._mmap_free = []
+        self._mmap_bytesused = 0
         self.cap = {
-                'video_capture' : v4l2.V4L2_CAP_VIDEO_CAPTURE,
-                'read_write' : v4l2.V4L2_CAP_READWRITE,
-                'stream' : v4l2.V4L2_CAP_STREAMING
+                'video_capture' : V4L2_CAP_VIDEO_CAPTURE,
+                'read_write' : V4L2_CAP_READWRITE,
+                'stream' : V4L2_CAP_STREAMING
+        }
+        self.pix = {
+                'YUYV' : V4L2_PIX_FMT_YUYV,
+                'NV12' : V4L2_PIX_FMT_NV12
         }
 
     def _verify_setup(self, ID):
@@ -56,9 +194,79 @@ class Loopback(object):
             sys.exit(1)
         return True
 
-    def write(self, bytes):
-        """ Parse write command to descriptor. """
-        self._fd.write(bytes)
+    def write(self, buf):
+        """ Write buffer protocol object to descriptor without copying. """
+        os.write(self._fd_int, buf)
+
+    def _request_buffers(self, count, size):
+        """ Map count output buffers of at least size bytes for mmap streaming and start the stream. """
+        try:
+            req = bytearray(V4L2_REQUESTBUFFERS.size)
+            V4L2_REQUESTBUFFERS.pack_into(req, 0, count, V4L2_BUF_TYPE_VIDEO_OUTPUT, V4L2_MEMORY_MMAP, 0, 0)
+            fcntl.ioctl(self._fd, VIDIOC_REQBUFS, req, True)
+            count = V4L2_REQUESTBUFFERS.unpack(bytes(req))[0]
+            if count < 1:
+                print('Device granted no mmap output buffers')
+                print('-> use io: write')
+                sys.exit(1)
+
+            self._mmaps = []
+            for index in range(count):
+                _, offset, length = self._ioctl_buffer(VIDIOC_QUERYBUF, index)
+                if length < size:
+                    print('Device buffer of {0} bytes is smaller than image of {1} bytes'.format(length, size))
+                    print('-> use io: write')
+                    sys.exit(1)
+                self._mmaps.append(mmap.mmap(self._fd_int, length, mmap.MAP_SHARED,
+                                             mmap.PROT_READ | mmap.PROT_WRITE, offset=offset))
+            fcntl.ioctl(self._fd, VIDIOC_STREAMON, struct.pack('i', V4L2_BUF_TYPE_VIDEO_OUTPUT))
+        except (IOError, OSError) as e:
+            print('Device mmap streaming failed: {}'.format(e))
+            print('-> use io: write')
+            sys.exit(1)
+        self._mmap_free = list(range(count))
+
+    def buffers(self, size):
+        """ Return views of size bytes on the mapped output buffers, None if they do not fit. """
+        if not self._mmaps or size > min(len(m) for m in self._mmaps):
+            return None
+        self._mmap_bytesused = size
+        return [numpy.frombuffer(m, dtype=numpy.uint8, count=size) for m in self._mmaps]
+
+    def release_buffers(self):
+        """ Stop mmap streaming and unmap the output buffers. """
+        if not self._mmaps:
+            return
+        fcntl.ioctl(self._fd, VIDIOC_STREAMOFF, struct.pack('i', V4L2_BUF_TYPE_VIDEO_OUTPUT))
+        for m in self._mmaps:
+            try:
+                m.close()
+            except BufferError:
+                # still exported to a frame in use, unmapped on garbage collection
+                pass
+        self._mmaps = []
+        self._mmap_free = []
+
+    def dequeue(self):
+        """ Return index of a mapped output buffer that may be filled. """
+        if self._mmap_free:
+            return self._mmap_free.pop()
+        return self._ioctl_buffer(VIDIOC_DQBUF)[0]
+
+    def queue(self, index):
+        """ Hand filled mapped output buffer over to the device. """
+        self._ioctl_buffer(VIDIOC_QBUF, index, self._mmap_bytesused)
+
+    def _ioctl_buffer(self, request, index=0, bytesused=0):
+        """ Issue buffer ioctl for a mapped output buffer and return (index, offset, length). """
+        fields = [index, V4L2_BUF_TYPE_VIDEO_OUTPUT, bytesused, 0, V4L2_FIELD_NONE]
+        fields += [0] * (V4L2_BUFFER_MEMORY - len(fields))
+        fields += [V4L2_MEMORY_MMAP, 0, 0, 0, 0]
+        buf = bytearray(V4L2_BUFFER.size)
+        V4L2_BUFFER.pack_into(buf, 0, *fields)
+        fcntl.ioctl(self._fd, request, buf, True)
+        fields = V4L2_BUFFER.unpack(bytes(buf))
+        return fields[0], fields[V4L2_BUFFER_MEMORY + 1] & 0xFFFFFFFF, fields[V4L2_BUFFER_MEMORY + 2]
 
     def can(self, capability):
         """ Return a boolean if capability is satisfied. """
@@ -66,20 +274,32 @@ class Loopback(object):
 
     def print_format(self, fmt):
         """ Print the format of the device. """
-        print('Width :          \t\t {}'.format(fmt.fmt.pix.width))
-        print('Height :         \t\t {}'.format(fmt.fmt.pix.height))
-        print('Pixelformat:     \t\t {:02X}'.format(fmt.fmt.pix.pixelformat))
-        print('  -> v4l2.V4L2_PIX_FMT_YUYV \t {0}'.format(bool(fmt.fmt.pix.pixelformat & v4l2.V4L2_PIX_FMT_YUYV)))
-        print('Bytes per line : \t\t {}'.format(fmt.fmt.pix.bytesperline))
-        print('Image size:      \t\t{}'.format(fmt.fmt.pix.sizeimage))
+        print('Width :          \t\t {}'.format(fmt['width']))
+        print('Height :         \t\t {}'.format(fmt['height']))
+        print('Pixelformat:     \t\t {:02X}'.format(fmt['pixelformat']))
+        for name, pixelformat in self.pix.items():
+            print('  -> V4L2_PIX_FMT_{0} \t\t {1}'.format(name, fmt['pixelformat'] == pixelformat))
+        print('Bytes per line : \t\t {}'.format(fmt['bytesperline']))
+        print('Image size:      \t\t{}'.format(fmt['sizeimage']))
+
+    def _ioctl_format(self, request, pix=None):
+        """ Issue format ioctl for the output buffer type and return its pixel format. """
+        fmt = bytearray(V4L2_FORMAT_SIZE)
+        struct.pack_into('I', fmt, 0, V4L2_BUF_TYPE_VIDEO_OUTPUT)
+        if pix is not None:
+            V4L2_PIX_FORMAT.pack_into(fmt, V4L2_FORMAT_PIX_OFFSET,
+                                      *[pix.get(field, 0) for field in V4L2_PIX_FIELDS])
+        fcntl.ioctl(self._fd, request, fmt, True)
+        return dict(zip(V4L2_PIX_FIELDS, V4L2_PIX_FORMAT.unpack_from(fmt, V4L2_FORMAT_PIX_OFFSET)))
 
     def _get_capabilities(self):
         """ Fetch capabilities and test if suitable for streamining. """
-        cp = v4l2.v4l2_capability()
-        fcntl.ioctl(self._fd, v4l2.VIDIOC_QUERYCAP, cp)
-        self.config.update(capabilities=cp.capabilities)
-        self.config.update(name=cp.card)
-        self.config.update(driver=cp.driver)
+        cp = bytearray(V4L2_CAPABILITY.size)
+        fcntl.ioctl(self._fd, VIDIOC_QUERYCAP, cp, True)
+        driver, card, _, _, capabilities = V4L2_CAPABILITY.unpack(bytes(cp))[:5]
+        self.config.update(capabilities=capabilities)
+        self.config.update(name=card.split(b'\0')[0].decode('utf8'))
+        self.config.update(driver=driver.split(b'\0')[0].decode('utf8'))
         if True or self._debug_is_enabled:
             print("Driver name  :           \t{}".format(self.config['name']))
             print("Driver capabilities :    \t0x{0:02X}".format(self.config['capabilities']))
@@ -89,47 +309,89 @@ class Loopback(object):
 
     def _get_format(self):
         """ Get current format. """
-        fmt = v4l2.v4l2_format()
-        fmt.type = v4l2.V4L2_BUF_TYPE_VIDEO_OUTPUT
-        fcntl.ioctl(self._fd, v4l2.VIDIOC_G_FMT, fmt)
+        fmt = self._ioctl_format(VIDIOC_G_FMT)
 
         print('Received format:')
         self.print_format(fmt)
 
-    def _set_format(self):
-        """ Set desired format. """
+    def _set_format(self, pixelformat='YUYV'):
+        """ Set desired format (packed 'YUYV' or semi-planar 'NV12'). """
         width = 1280
         height = 720
-        fmt = v4l2.v4l2_format()
-        fmt.type = v4l2.V4L2_BUF_TYPE_VIDEO_OUTPUT
-
-        fmt.fmt.pix.pixelformat = v4l2.V4L2_PIX_FMT_YUYV
-        fmt.fmt.pix.width = width
-        fmt.fmt.pix.height = height
-        fmt.fmt.pix.field = v4l2.V4L2_FIELD_NONE
-        fmt.fmt.pix.bytesperline = width * 2
-        fmt.fmt.pix.sizeimage = width * height * 2
-        fcntl.ioctl(self._fd, v4l2.VIDIOC_S_FMT, fmt)
+        pix = dict(pixelformat=self.pix[pixelformat],
+                   width=width,
+                   height=height,
+                   field=V4L2_FIELD_NONE,
+                   # All conversions produce limited range ITU-R BT.601
+                   colorspace=V4L2_COLORSPACE_SMPTE170M,
+                   priv=V4L2_PIX_FMT_PRIV_MAGIC,
+                   ycbcr_enc=V4L2_YCBCR_ENC_601,
+                   quantization=V4L2_QUANTIZATION_LIM_RANGE)
+        if pixelformat == 'NV12':
+            pix.update(bytesperline=width)
+            pix.update(sizeimage=width * height * 3 // 2)
+        else:
+            pix.update(bytesperline=width * 2)
+            pix.update(sizeimage=width * height * 2)
+        fmt = self._ioctl_format(VIDIOC_S_FMT, pix)
 
         print('Updated format:')
         self.print_format(fmt)
+        return fmt
 
     def _set_output(self):
         """ Define output stream. """
         raise NotImplementedError
 
-    def configure_stream(self, ID=None):
+    def configure_stream(self, ID=None, pixelformat='YUYV', io='write'):
         """ Configure stream if ID is provided,
             otherwise assume it already is and update.
+            Maps the output buffers for 'mmap' io.
         """
         if ID is not None:
             self._verify_setup(ID)
             self._fd = open('/dev/video' + str(ID), 'rb+', buffering=0)
+            self._fd_int = self._fd.fileno()
         self._get_capabilities()
         self._get_format()
-        self._set_format()
+        fmt = self._set_format(pixelformat)
+        if io == 'mmap':
+            self._request_buffers(MMAP_BUFFERS, fmt['sizeimage'])
 
 NS2S = 1.e-9
+# Smoothing factor of the exponentially weighted FPS estimate
+FPS_ALPHA = 0.1
+# Minimum interval between FPS log messages in seconds
+FPS_LOG_PERIOD = 1.
+# Subscriber receive buffer in bytes, fits a 720p or 1080p RGBA frame (rospy default 64 KB)
+BUFF_SIZE = 2**24
+# Supported methods of passing frames to the device
+IO_METHODS = ('write', 'mmap')
+# Mapped output buffers requested for mmap io
+MMAP_BUFFERS = 2
+# Device write errors after which streaming cannot recover
+FATAL_WRITE_ERRNOS = (errno.EBADF, errno.ENODEV, errno.ENXIO)
+# Channels of the supported 8 bit source image encodings
+ENCODING_CHANNELS = {'bgra8': 4, 'bgr8': 3, 'rgba8': 4, 'rgb8': 3}
+# Serialised std_msgs/Header prefix: seq, stamp.secs, stamp.nsecs, length of frame_id
+HEADER_PREFIX = struct.Struct('<4I')
+
+
+def _parse_image(buff):
+    """ Parse fixed fields of a serialised sensor_msgs/Image.
+
+        Returns:
+            height, width, encoding, step and byte offset of the pixel data
+    """
+    offset = HEADER_PREFIX.size + HEADER_PREFIX.unpack_from(buff, 0)[3]
+    height, width, length = struct.unpack_from('<3I', buff, offset)
+    offset += 12
+    encoding = bytes(buff[offset:offset + length]).decode('ascii')
+    offset += length
+    # is_bigendian, step and length of data
+    _, step, _ = struct.unpack_from('<B2I', buff, offset)
+    return height, width, encoding, step, offset + 9
+
 
 class WebRTCROSMediaDevice:
     """ Parser for ROS image streams to loopback device for WebRTC Mediastream.
@@ -152,12 +414,20 @@ class WebRTCROSMediaDevice:
         topic = rospy.get_param('~stream/{}/topic'.format(stream_name), '~failed_input_topic')
         # Define desired output frequency
         frequency = rospy.get_param('~stream/{}/frequency'.format(stream_name), 0)
+        # Define output pixel format -> 'YUYV' or 'NV12'
+        self._format = rospy.get_param('~stream/{}/format'.format(stream_name), 'YUYV')
+        # Define output I/O method -> 'write' or 'mmap' streaming
+        self._io = rospy.get_param('~stream/{}/io'.format(stream_name), 'write')
 
         # Define some statistics
-        self._drop_frames = [self._drop_no_frames if frequency == 0 else self._drop_frames][0]
+        if frequency == 0:
+            self._drop_frames = self._drop_no_frames
         self._output_rate = rospy.Rate(max(0.001, frequency)) # not used if freq=0
         self._deadline_next_frame = rospy.Time.now() + self._output_rate.sleep_dur
-        self._stamp = rospy.Time.now()
+        # FPS estimate is seeded by the interval between the first two frames
+        self._stamp = None
+        self._stamp_log = rospy.Time.now()
+        self._fps = None
 
         # Attempt startup (verbosified)
         print('Start WebRTC streamer:')
@@ -165,73 +435,319 @@ class WebRTCROSMediaDevice:
         print('ID:          \t {}'.format(ID))
         print('Topic:       \t {}'.format(topic))
         print('Frequency:   \t {}'.format(frequency))
+        print('Format:      \t {}'.format(self._format))
+        print('I/O:         \t {}'.format(self._io))
+        if self._io not in IO_METHODS:
+            print('I/O: {0} not in {1}'.format(self._io, list(IO_METHODS)))
+            print('-> check io parameter of stream')
+            sys.exit(1)
 
-        self._device = Loopback(stream)
-        self._device.configure_stream(ID)
+        # Parallelise OpenCV conversions (effective if built with TBB/OpenMP/pthreads)
+        cv2.setNumThreads(max(1, multiprocessing.cpu_count() // 2))
+        build = cv2.getBuildInformation().splitlines()
+        parallel = [l.split(':', 1)[-1].strip() for l in build if 'Parallel framework' in l]
+        print('OpenCV:      \t {0} threads ({1})'.format(cv2.getNumThreads(),
+                                                     parallel[0] if parallel else 'unknown'))
 
-        self._idx = {
-                'buffer': {'Y': None, 'U': None, 'V': None},
-                'source': {'Y': None, 'U': None, 'V': None}
-        }
-        self._buffer = None
-        self._bridge = CvBridge()
+        self._device = Loopback(stream)
+        if self._format not in self._device.pix:
+            print('Format: {0} not in {1}'.format(self._format, sorted(self._device.pix)))
+            print('-> check format parameter of stream')
+            sys.exit(1)
+        self._device.configure_stream(ID, self._format, self._io)
+
+        # Double buffered output frames, converted in callback and
+        # either written by writer thread or queued as mapped device buffers
+        self._frames = []
+        self._frame_latest = None
+        self._frame_writing = None
+        self._frame_lock = threading.Lock()
+        self._frame_ready = threading.Event()
+        # Serialises conversions with the release of mapped buffers on shutdown
+        self._convert_lock = threading.Lock()
+        if self._io == 'mmap':
+            self._acquire_frame = self._device.dequeue
+            self._publish_frame = self._device.queue
+            rospy.on_shutdown(self._release_frames)
+        else:
+            self._writer = threading.Thread(target=self._writer_loop)
+            self._writer.daemon = True
+            self._writer.start()
+
+        self._yuv = None
+        self._convert = None
+        self._code_yuv = None
+        self._code_yuy2 = None
+        self._bt601 = None
+        self._shape = None
+        self._strides = None
+        self._data_offset = None
+        self._data_bytes = None
         self._output_topic = topic
-        self._sub_image = rospy.Subscriber(self._output_topic, Image,
-                                        self._cb_init,
-                                        queue_size=1,
-                                        tcp_nodelay=True)
+        self._sub_image = self._subscribe(self._cb_init)
+
+    def _subscribe(self, callback):
+        """ Subscribe to the source topic with a receive buffer sized for full frames. """
+        return rospy.Subscriber(self._output_topic, rospy.AnyMsg, callback,
+                                queue_size=1,
+                                buff_size=BUFF_SIZE,
+                                tcp_nodelay=True)
 
-    def _drop_no_frames(self):
+    def _drop_no_frames(self, now):
         """ Drop no frames, always handle callback. """
         return False
 
-    def _drop_frames(self):
+    def _drop_frames(self, now):
         """ Drop frames if frequency of subscriber callbacks exceeds specified frequency. """
-        if self._deadline_next_frame < rospy.Time.now():
-            self._deadline_next_frame = rospy.Time.now() + self._output_rate.sleep_dur
+        if self._deadline_next_frame < now:
+            self._deadline_next_frame = now + self._output_rate.sleep_dur
             return False
         return True
 
     def _cb_init(self, img_input):
         """ Fetch initialisation parameteres from topic. """
-        img_cv = self._bridge.imgmsg_to_cv2(img_input)
-        img_rgb = cv2.cvtColor(img_cv, cv2.cv2.COLOR_RGBA2BGR)
-        img_yuv = cv2.cvtColor(img_cv, cv2.cv2.COLOR_BGR2YUV)
-
-        height, width, ch = img_cv.shape
-        lb = width * height * 2
+        msg_type = img_input._connection_header['type']
+        if msg_type != 'sensor_msgs/Image':
+            print('Topic type: {0} is not sensor_msgs/Image'.format(msg_type))
+            rospy.signal_shutdown('unsupported topic type')
+            return
+        height, width, encoding, step, offset = _parse_image(img_input._buff)
+        if encoding not in ENCODING_CHANNELS:
+            print('Encoding: {0} not in {1}'.format(encoding, list(ENCODING_CHANNELS)))
+            rospy.signal_shutdown('unsupported image encoding')
+            return
+        ch = ENCODING_CHANNELS[encoding]
+        self._shape = (height, width, ch)
+        self._strides = (step, ch, 1)
+        # Pixel data offset without the variable length frame_id
+        self._data_offset = offset - HEADER_PREFIX.unpack_from(img_input._buff, 0)[3]
+        self._data_bytes = height * step
+        img_cv = self._decode(img_input)
+        if img_cv is None:
+            print('Image data does not match {0}x{1} {2} with step {3}'.format(height, width, encoding, step))
+            rospy.signal_shutdown('inconsistent image data')
+            return
 
-        img_yuv_rav = img_yuv.ravel()
-        l = len(img_yuv_rav)
+        # Source channel order decides the colour conversion
+        is_bgr = not encoding.startswith('rgb')
+        with self._convert_lock:
+            buffers = self._allocate_buffers(self._frame_bytes(height, width))
+            if buffers is None:
+                print('Frame of {0}x{1} does not fit the mapped device buffers'.format(width, height))
+                print('-> check source resolution against device format')
+                rospy.signal_shutdown('mmap output buffer too small')
+                return
+            if self._format == 'NV12':
+                self._init_nv12(img_cv, is_bgr, buffers)
+            else:
+                self._init_yuyv(img_cv, is_bgr, buffers)
+        print('Conversion:  \t {}'.format(self._convert.__name__))
+        self._sub_image.unregister()
+        self._sub_image = self._subscribe(self._cb_yuyv)
 
-        self._idx['source']['Y'] = numpy.arange(0, l, 3)
-        self._idx['source']['U'] = numpy.arange(1, l, 6)
-        self._idx['source']['V'] = numpy.arange(2, l, 6)
-        self._idx['buffer']['Y'] = numpy.arange(0, lb, 2)
-        self._idx['buffer']['U'] = numpy.arange(1, lb, 4)
-        self._idx['buffer']['V'] = numpy.arange(3, lb, 4)
+    def _decode(self, img_input):
+        """ View pixel data of raw image message as (H, W, C) array without deserialising.
 
-        self._buffer = numpy.zeros(lb, dtype=numpy.uint8)
-        self._sub_image.unregister()
-        self._sub_image = rospy.Subscriber(self._output_topic, Image,
-                                        self._cb_yuyv,
-                                        queue_size=1, tcp_nodelay=True)
+            Returns:
+                None if the data length differs from the initial image layout
+        """
+        buff = img_input._buff
+        offset = self._data_offset + HEADER_PREFIX.unpack_from(buff, 0)[3]
+        length = struct.unpack_from('<I', buff, offset - 4)[0]
+        if length != self._data_bytes or len(buff) - offset < length:
+            return None
+        return numpy.ndarray(self._shape, dtype=numpy.uint8, buffer=buff,
+                             offset=offset, strides=self._strides)
+
+    def _frame_bytes(self, height, width):
+        """ Return size of an output frame in the configured pixel format. """
+        if self._format == 'NV12':
+            return width * height * 3 // 2
+        return width * height * 2
+
+    def _allocate_buffers(self, lb):
+        """ Return output frame buffers of lb bytes, two or as many mmap buffers as granted.
+
+            Returns:
+                None if the frame does not fit the mapped device buffers
+        """
+        if self._io == 'mmap':
+            return self._device.buffers(lb)
+        return [_aligned_zeros(lb) for _ in range(2)]
+
+    def _code_i420(self, ch, is_bgr):
+        """ Return OpenCV code converting the source to limited range BT.601 I420. """
+        if ch == 4:
+            return cv2.COLOR_BGRA2YUV_I420 if is_bgr else cv2.COLOR_RGBA2YUV_I420
+        return cv2.COLOR_BGR2YUV_I420 if is_bgr else cv2.COLOR_RGB2YUV_I420
+
+    def _bt601_matrix(self, ch, is_bgr):
+        """ Return cv2.transform matrix mapping source channels to limited range BT.601 YUV. """
+        m = numpy.zeros((3, ch + 1))
+        m[:, :3] = BT601[:, [2, 1, 0] if is_bgr else [0, 1, 2]]
+        m[:, ch] = BT601[:, 3]
+        return m
+
+    def _init_yuyv(self, img_cv, is_bgr, buffers):
+        """ Set up yuyv views on the output buffers and select conversion. """
+        height, width, ch = img_cv.shape
+        # Packed conversion codes are only provided by OpenCV >= 4.7
+        self._code_yuy2 = getattr(cv2, 'COLOR_{0}{1}2YUV_YUY2'.format(
+                'BGR' if is_bgr else 'RGB', 'A' if ch == 4 else ''), None)
+
+        self._frames = []
+        for buffer in buffers:
+            # Strided views on the YUYV buffer (Y0 U Y1 V per pixel pair)
+            self._frames.append({
+                    'buffer': buffer,
+                    'buf2': buffer.reshape(height, width, 2),
+                    'buf4': buffer.reshape(height, width // 2, 4)
+            })
+        # libyuv 'ARGB' is BGRA in memory and converts in a single pass
+        if LIBYUV is not None and is_bgr and ch == 4:
+            self._convert = self._convert_libyuv
+        elif self._code_yuy2 is not None:
+            self._convert = self._convert_opencv_yuy2
+        elif numba is not None and is_bgr and img_cv.flags.c_contiguous:
+            self._convert = self._convert_numba
+        else:
+            # Only the view based fallback needs the YUV scratch image
+            self._yuv = _aligned_zeros(height * width * 3).reshape(height, width, 3)
+            self._bt601 = self._bt601_matrix(ch, is_bgr)
+            self._convert = self._convert_opencv
+
+    def _init_nv12(self, img_cv, is_bgr, buffers):
+        """ Set up nv12 views on the output buffers and select conversion. """
+        height, width, ch = img_cv.shape
+        self._code_yuv = self._code_i420(ch, is_bgr)
+
+        self._frames = []
+        for buffer in buffers:
+            # Views on the NV12 buffer (Y plane followed by interleaved UV plane)
+            self._frames.append({
+                    'buffer': buffer,
+                    'y': buffer[:width * height].reshape(height, width),
+                    'uv': buffer[width * height:].reshape(height // 2, width // 2, 2)
+            })
+        if LIBYUV is not None and is_bgr and ch == 4:
+            self._convert = self._convert_libyuv_nv12
+        else:
+            self._yuv = _aligned_zeros(height * width * 3 // 2).reshape(height * 3 // 2, width)
+            self._convert = self._convert_opencv_nv12
+
+    def _convert_libyuv(self, img_cv, frame):
+        """ Convert BGRA image to yuyv buffer in a single libyuv pass. """
+        height, width = img_cv.shape[:2]
+        LIBYUV.ARGBToYUY2(img_cv.ctypes.data, img_cv.strides[0],
+                          frame['buffer'].ctypes.data, width * 2,
+                          width, height)
+
+    def _convert_libyuv_nv12(self, img_cv, frame):
+        """ Convert BGRA image to nv12 buffer in a single libyuv pass. """
+        height, width = img_cv.shape[:2]
+        LIBYUV.ARGBToNV12(img_cv.ctypes.data, img_cv.strides[0],
+                          frame['y'].ctypes.data, width,
+                          frame['uv'].ctypes.data, width,
+                          width, height)
+
+    def _convert_numba(self, img_cv, frame):
+        """ Convert BGR(A) image to yuyv buffer with the compiled single pass kernel. """
+        _bgr_to_yuyv(img_cv, frame['buf4'])
+
+    def _convert_opencv_yuy2(self, img_cv, frame):
+        """ Convert image to yuyv buffer with the vectorised OpenCV packed conversion. """
+        cv2.cvtColor(img_cv, self._code_yuy2, dst=frame['buf2'])
+
+    def _convert_opencv(self, img_cv, frame):
+        """ Convert image to yuyv buffer with an OpenCV BT.601 transform and strided views. """
+        img_yuv = cv2.transform(img_cv, self._bt601, dst=self._yuv)
+
+        frame['buf2'][..., 0] = img_yuv[..., 0]
+        frame['buf4'][..., 1] = img_yuv[:, ::2, 1]
+        frame['buf4'][..., 3] = img_yuv[:, ::2, 2]
+
+    def _convert_opencv_nv12(self, img_cv, frame):
+        """ Convert image to nv12 buffer by interleaving the OpenCV I420 chroma planes. """
+        img_i420 = cv2.cvtColor(img_cv, self._code_yuv, dst=self._yuv)
+        height, width = frame['y'].shape
+        chroma = img_i420[height:].reshape(2, height // 2, width // 2)
+
+        frame['y'][...] = img_i420[:height]
+        frame['uv'][..., 0] = chroma[0]
+        frame['uv'][..., 1] = chroma[1]
+
+    def _release_frames(self):
+        """ Drop frame views and release the mapped device buffers. """
+        with self._convert_lock:
+            self._frames = []
+            self._device.release_buffers()
+
+    def _acquire_frame(self):
+        """ Return index of the output frame that is neither written nor pending. """
+        with self._frame_lock:
+            busy = self._frame_writing
+            if busy is None:
+                busy = self._frame_latest
+            idx = 1 if busy == 0 else 0
+            if self._frame_latest == idx:
+                self._frame_latest = None
+        return idx
+
+    def _publish_frame(self, idx):
+        """ Hand converted output frame over to the writer thread. """
+        with self._frame_lock:
+            self._frame_latest = idx
+            self._frame_ready.set()
+
+    def _writer_loop(self):
+        """ Write the most recent converted frame to the device. """
+        while not rospy.is_shutdown():
+            if not self._frame_ready.wait(0.1):
+                continue
+            with self._frame_lock:
+                idx = self._frame_latest
+                self._frame_latest = None
+                self._frame_writing = idx
+                self._frame_ready.clear()
+            if idx is None:
+                continue
+            try:
+                self._device.write(self._frames[idx]['buffer'])
+            except (IOError, OSError) as e:
+                rospy.logerr('Writing frame to device failed: {}'.format(e))
+                if e.errno in FATAL_WRITE_ERRNOS:
+                    rospy.signal_shutdown('device write failed')
+            finally:
+                with self._frame_lock:
+                    self._frame_writing = None
 
     def _cb_yuyv(self, img_input):
-        """ Convert image to yuyv buffer format. """
-        if self._drop_frames():
+        """ Convert image to yuyv or nv12 buffer format. """
+        now = rospy.Time.now()
+        if self._drop_frames(now):
             return
-        img_cv = self._bridge.imgmsg_to_cv2(img_input)
-        img_rgb = cv2.cvtColor(img_cv, cv2.cv2.COLOR_RGBA2BGR)
-        img_yuv = cv2.cvtColor(img_cv, cv2.cv2.COLOR_BGR2YUV).ravel()
-
-        for key, idxs in self._idx['buffer'].items():
-            self._buffer[idxs] = img_yuv[self._idx['source'][key]]
-        self._device.write(self._buffer.tostring())
-
-        f = 1.  / ((rospy.Time.now() - self._stamp).to_sec())
-        self._stamp = rospy.Time.now()
-        print('FPS : \t {0:2.0f} Hz'.format(f))
+        img_cv = self._decode(img_input)
+        if img_cv is None:
+            rospy.logerr_throttle(FPS_LOG_PERIOD, 'Image data does not match initial image layout, dropping frame')
+            return
+        with self._convert_lock:
+            # Released on shutdown
+            if not self._frames:
+                return
+            idx = self._acquire_frame()
+            self._convert(img_cv, self._frames[idx])
+            self._publish_frame(idx)
+
+        dt = 0. if self._stamp is None else (now - self._stamp).to_sec()
+        self._stamp = now
+        if dt > 0:
+            if self._fps is None:
+                self._fps = 1. / dt
+            else:
+                self._fps += FPS_ALPHA * (1. / dt - self._fps)
+        if self._fps is not None and (now - self._stamp_log).to_sec() > FPS_LOG_PERIOD:
+            self._stamp_log = now
+            rospy.loginfo('FPS : \t %2.0f Hz', self._fps)
 
     def stream(self):
         """ Idle node with active subscription thread to maintain streaming. """